@@ -0,0 +1,256 @@
+"""
+In-memory pages and static files, pre-compressed, with ETags and 304s.
+
+Every file is read once, compressed once (gzip, plus brotli when the
+optional `brotli` package is installed) and kept in an AssetCache. A hit
+picks the smallest encoding the client accepts and answers revalidations
+(If-None-Match) with 304 Not Modified without touching the disk. The ETag
+is a hash of the file content, so it survives restarts and is the same on
+every worker.
+
+StaticAssets is an ASGI app replacing StaticFiles for the /static mount,
+and JSONCompressionMiddleware gzips JSON responses above a size threshold.
+Both are pure ASGI, like metrics.MetricsMiddleware.
+
+With reload=True (ASSET_RELOAD=true in main) each hit stats the file and
+re-reads it when its mtime changed, for editing templates without restarts.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+# Compressing these again gains nothing (.docx and .png are already zip / deflate)
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def accepted_encodings(header: str) -> set:
+    """Content codings an Accept-Encoding header allows (q=0 excluded)."""
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if name and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.lower())
+    return accepted
+
+
+class Asset:
+    """One file held in memory with its compressed variants."""
+
+    def __init__(self, body: bytes, media_type: str, mtime: float):
+        self.media_type = media_type
+        self.mtime = mtime
+        self.etag_base = hashlib.sha1(body).hexdigest()[:20]
+        # encoding -> body; "identity" always present
+        self.variants = {"identity": body}
+        if media_type.startswith(COMPRESSIBLE_TYPES) and len(body) > 256:
+            self.variants["gzip"] = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            brotli = _brotli()
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        for encoding in [e for e in self.variants if e != "identity"]:
+            if len(self.variants[encoding]) >= len(body):
+                del self.variants[encoding]
+
+    def etag(self, encoding: str) -> str:
+        # Each content coding is a different representation, hence its own tag
+        return f'"{self.etag_base}"' if encoding == "identity" else f'"{self.etag_base}-{encoding}"'
+
+    def not_modified(self, if_none_match: str) -> bool:
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            # Weak comparison, and any coding of the same content matches
+            tag = tag[2:] if tag.startswith("W/") else tag
+            if tag.strip('"').split("-", 1)[0] == self.etag_base:
+                return True
+        return False
+
+    def respond(self, accept_encoding: str, if_none_match: str, cache_control: str):
+        """(status, headers, body) for a GET of this asset."""
+        encoding = "identity"
+        if len(self.variants) > 1:
+            accepted = accepted_encodings(accept_encoding)
+            options = [e for e in self.variants if e in accepted]
+            if options:
+                encoding = min(options, key=lambda e: len(self.variants[e]))
+        headers = {"etag": self.etag(encoding), "cache-control": cache_control}
+        if len(self.variants) > 1:
+            headers["vary"] = "Accept-Encoding"
+        if self.not_modified(if_none_match):
+            return 304, headers, b""
+        body = self.variants[encoding]
+        headers["content-type"] = self.media_type
+        headers["content-length"] = str(len(body))
+        if encoding != "identity":
+            headers["content-encoding"] = encoding
+        return 200, headers, body
+
+
+class AssetCache:
+    """Assets under a root directory, loaded on first use (or by preload())."""
+
+    def __init__(self, root: str, reload: bool = False):
+        self.root = os.path.abspath(root)
+        self.reload = reload
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def _path(self, rel_path: str):
+        path = os.path.abspath(os.path.join(self.root, rel_path))
+        return path if path.startswith(self.root + os.sep) else None
+
+    def get(self, rel_path: str):
+        """The Asset for a path relative to the root, or None when there is no such file."""
+        asset = self._assets.get(rel_path)
+        if asset is not None and not self.reload:
+            return asset
+        path = self._path(rel_path)
+        if path is None or not os.path.isfile(path):
+            return None
+        mtime = os.path.getmtime(path)
+        if asset is not None and asset.mtime == mtime:
+            return asset
+        with open(path, "rb") as f:
+            body = f.read()
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if media_type.startswith("text/"):
+            media_type += "; charset=utf-8"
+        asset = Asset(body, media_type, mtime)
+        with self._lock:
+            self._assets[rel_path] = asset
+        return asset
+
+    def preload(self, rel_paths=None):
+        """Loads the given files, or every file under the root; returns the number loaded."""
+        if rel_paths is None:
+            rel_paths = [
+                os.path.relpath(os.path.join(dirpath, name), self.root).replace(os.sep, "/")
+                for dirpath, _, names in os.walk(self.root) for name in names
+            ]
+        return sum(1 for rel_path in rel_paths if self.get(rel_path) is not None)
+
+
+def route_path(scope) -> str:
+    """
+    The request path below the mount point. Newer Starlette keeps the full
+    path in scope["path"] under a Mount and puts the mount prefix in
+    root_path; older versions strip it from path. Same rule as Starlette's
+    get_route_path, which StaticFiles uses.
+    """
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        if path == root_path:
+            return ""
+        if path[len(root_path)] == "/":
+            return path[len(root_path):]
+    return path
+
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+async def send_asset(asset: Asset, scope, send, cache_control: str):
+    status, headers, body = asset.respond(
+        _header(scope, b"accept-encoding"), _header(scope, b"if-none-match"), cache_control)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+
+class StaticAssets:
+    """ASGI app serving an AssetCache (GET and HEAD), mounted in place of StaticFiles."""
+
+    def __init__(self, cache: AssetCache, cache_control: str):
+        self.cache = cache
+        self.cache_control = cache_control
+
+    async def __call__(self, scope, receive, send):
+        asset = None
+        if scope["method"] in ("GET", "HEAD"):
+            asset = self.cache.get(route_path(scope).lstrip("/"))
+        if asset is None:
+            status = 404 if scope["method"] in ("GET", "HEAD") else 405
+            body = b"Not Found" if status == 404 else b"Method Not Allowed"
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        await send_asset(asset, scope, send, self.cache_control)
+
+
+class JSONCompressionMiddleware:
+    """
+    Gzips application/json responses of at least `minimum_size` bytes for
+    clients that accept gzip. JSON responses arrive as one body message, so
+    only those are buffered; everything else (pages, downloads, zips,
+    already-encoded bodies) streams through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, level: int = 6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or "gzip" not in accepted_encodings(_header(scope, b"accept-encoding")):
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = dict((k.lower(), v) for k, v in message.get("headers", []))
+                if headers.get(b"content-type", b"").startswith(b"application/json") and b"content-encoding" not in headers:
+                    start = message
+                    return
+                await send(message)
+            elif message["type"] == "http.response.body" and start is not None:
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                await self._send_json(start, b"".join(chunks), send)
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _send_json(self, start, body: bytes, send):
+        headers = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+        vary = [v for k, v in start.get("headers", []) if k.lower() == b"vary"]
+        vary_value = b", ".join(vary + [b"Accept-Encoding"])
+        if len(body) >= self.minimum_size:
+            body = gzip.compress(body, self.level)
+            headers.append((b"content-encoding", b"gzip"))
+        headers += [(b"content-length", str(len(body)).encode()), (b"vary", vary_value)]
+        await send({**start, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,227 @@
+"""
+Conversion micro-benchmarks.
+
+Generates synthetic question-table documents (see synthetic_docx.py), runs
+them through the same pipeline as the web app (converter.convert with an
+attachments dict, then converter.render per format) and writes the timings
+as JSON:
+
+    python benchmark.py --rows 20,200,2000 --images 0,10 --output bench.json
+    python benchmark.py --content unicode,escaping --image-size 800x600
+    python benchmark.py --compare bench_old.json bench.json --threshold 0.15
+
+Stages: fast_extraction, office_export, html_parse, text_cleanup,
+image_encoding, extraction, format_gift, format_hemis, format_moodlexml.
+The office export needs LibreOffice (or Word on Windows); without it, or
+with --skip-export, the HTML an export would produce is generated directly
+and the remaining stages are timed.
+
+Each case runs in a fresh process so peak RSS belongs to that case alone.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import converter
+from synthetic_docx import CONTENT_KINDS, make_questions, write_docx, write_html
+
+FORMATS = ("gift", "hemis", "moodlexml")
+STAGES = [
+    "fast_extraction", "office_export", "html_parse", "text_cleanup", "image_encoding",
+    "extraction", "format_gift", "format_hemis", "format_moodlexml",
+]
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def office_available():
+    if platform.system() == "Windows":
+        try:
+            import win32com.client  # noqa: F401
+            return True
+        except ImportError:
+            return False
+    return shutil.which("libreoffice") is not None
+
+
+def run_case(case: dict, repeat: int, use_office: bool):
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        image_size = tuple(case["image_size"])
+        questions = make_questions(
+            case["rows"], case["distractors"], case["content"], case["image_every"]
+        )
+        docx_path = write_docx(os.path.join(workdir, "case.docx"), questions, image_size)
+
+        runs = []
+        output_bytes = {}
+        parsed = []
+        for i in range(repeat):
+            timings = {}
+            attachments = {}
+            if use_office:
+                parsed = converter.convert(docx_path, timings=timings, attachments=attachments)
+            else:
+                html_dir = os.path.join(workdir, f"run{i}")
+                os.makedirs(html_dir)
+                html_path, files_dir = write_html(html_dir, "case", questions, image_size)
+                parsed = converter.questions_from_html(html_path, html_dir, files_dir, timings, attachments)
+
+            for fmt in FORMATS:
+                start = time.perf_counter()
+                content = converter.render(parsed, fmt, attachments)
+                timings[f"format_{fmt}"] = time.perf_counter() - start
+                output_bytes[fmt] = len(content)
+            runs.append(timings)
+
+        stages = {}
+        for stage in STAGES:
+            values = [r[stage] for r in runs if stage in r]
+            if values:
+                stages[stage] = {
+                    "min": min(values),
+                    "median": statistics.median(values),
+                    "max": max(values),
+                }
+
+        return {
+            "case": case,
+            "questions": len(parsed),
+            "input_bytes": os.path.getsize(docx_path),
+            "output_bytes": output_bytes,
+            "stages": stages,
+            "total_median": sum(s["median"] for s in stages.values()),
+            "peak_rss_kb": peak_rss_kb(),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def case_key(case: dict):
+    return json.dumps(case, sort_keys=True)
+
+
+def compare(old_path: str, new_path: str, threshold: float):
+    """Prints per-stage median changes; returns the number of regressions."""
+    with open(old_path, encoding="utf-8") as f:
+        old = {case_key(r["case"]): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for result in new:
+        before = old.get(case_key(result["case"]))
+        if not before:
+            continue
+        print(case_key(result["case"]))
+        for stage, stats in result["stages"].items():
+            if stage not in before["stages"]:
+                continue
+            was, now = before["stages"][stage]["median"], stats["median"]
+            change = (now - was) / was if was else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {stage:<15} {was * 1000:10.2f} ms -> {now * 1000:10.2f} ms  {change:+7.1%}{flag}")
+        if before.get("peak_rss_kb") and result.get("peak_rss_kb"):
+            print(f"  {'peak_rss':<15} {before['peak_rss_kb']:10d} KB -> {result['peak_rss_kb']:10d} KB")
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def size_list(value):
+    return [tuple(int(n) for n in v.lower().split("x")) for v in value.split(",") if v]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int_list, default=[20, 200, 1000], help="question counts, comma separated")
+    parser.add_argument("--distractors", type=int_list, default=[3], help="distractors per question")
+    parser.add_argument("--images", type=int_list, default=[0, 10],
+                        help="put an image on every Nth question (0 = no images)")
+    parser.add_argument("--image-size", type=size_list, default=[(200, 150)], help="WxH in pixels, comma separated")
+    parser.add_argument("--content", default="plain", help=f"any of {', '.join(CONTENT_KINDS)}, comma separated")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-export", action="store_true", help="benchmark from generated HTML")
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown counted as regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        print(f"\n{regressions} stage regression(s) over {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    use_office = not args.skip_export and office_available()
+    if not args.skip_export and not use_office:
+        print("Office export not available, timing from generated HTML")
+
+    contents = [c for c in args.content.split(",") if c]
+    for c in contents:
+        if c not in CONTENT_KINDS:
+            parser.error(f"unknown content kind: {c}")
+
+    cases = [
+        {"rows": r, "distractors": d, "image_every": i, "image_size": list(s), "content": c}
+        for r, d, i, s, c in itertools.product(args.rows, args.distractors, args.images, args.image_size, contents)
+    ]
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            result = pool.submit(run_case, case, args.repeat, use_office).result()
+        results.append(result)
+        stages = ", ".join(f"{k}={v['median'] * 1000:.1f}ms" for k, v in result["stages"].items())
+        print(f"{case_key(case)}: {result['questions']} questions, rss={result['peak_rss_kb']} KB; {stages}")
+
+    report = {
+        "revision": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "office_export": use_office,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Offline bulk conversion of a directory tree of .doc/.docx question files.
+
+Runs the same pipeline as the web app (converter.convert and
+converter.render) in a process pool, without HTTP, Postgres or billing:
+
+    python bulk_convert.py archive/ converted/
+    python bulk_convert.py archive/ converted/ --format gift,hemis --workers 8
+    python bulk_convert.py archive/ converted/ --report report.csv --force
+
+Outputs mirror the source tree: archive/2019/fizika.docx becomes
+converted/2019/fizika.gift.txt (and .hemis.txt, .xml for moodlexml).
+A file is skipped when all its outputs exist and the source is unchanged
+since the last run: same mtime and size, or, when those differ, the same
+SHA-256. That state lives in OUT_DIR/.bulk_convert_state.json.
+
+The report (JSON, or CSV when the name ends in .csv) has one row per file
+with its status, question count and per-stage timings.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import converter
+
+SOURCE_EXTENSIONS = (".doc", ".docx")
+FORMATS = ("gift", "hemis", "moodlexml")
+STATE_FILE = ".bulk_convert_state.json"
+# The state file is rewritten whole, so during a run it is saved only this often
+STATE_SAVE_EVERY_FILES = 100
+STATE_SAVE_EVERY_SECONDS = 10.0
+STAGES = [
+    "fast_extraction", "office_export", "html_parse", "text_cleanup", "image_encoding",
+    "extraction", "format_gift", "format_hemis", "format_moodlexml",
+]
+
+
+def output_name(rel_path: str, fmt: str) -> str:
+    stem = os.path.splitext(rel_path)[0]
+    return f"{stem}.xml" if fmt == "moodlexml" else f"{stem}.{fmt}.txt"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_sources(src_dir: str):
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(files):
+            # ~$name.docx are Word lock files
+            if name.lower().endswith(SOURCE_EXTENSIONS) and not name.startswith("~$"):
+                yield os.path.relpath(os.path.join(root, name), src_dir)
+
+
+def load_state(out_dir: str) -> dict:
+    try:
+        with open(os.path.join(out_dir, STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(out_dir: str, state: dict):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def up_to_date(src_path: str, out_dir: str, rel_path: str, formats, record):
+    """
+    Returns (is current, sha256 or None). The hash is only computed when
+    mtime or size moved, so an unchanged tree costs one stat per file.
+    """
+    if not record or not all(os.path.exists(os.path.join(out_dir, output_name(rel_path, f))) for f in formats):
+        return False, None
+    if not set(formats) <= set(record.get("formats", ())):
+        return False, None
+    stat = os.stat(src_path)
+    if stat.st_mtime == record.get("mtime") and stat.st_size == record.get("size"):
+        return True, record.get("sha256")
+    sha256 = file_sha256(src_path)
+    return sha256 == record.get("sha256"), sha256
+
+
+def _init_worker(profiles_root: str):
+    # Each worker runs its own soffice, which needs a profile of its own. Pool
+    # workers exit without running atexit handlers, so main() removes
+    # profiles_root with all of them once the pool is done.
+    os.environ["LIBREOFFICE_PROFILE_DIR"] = tempfile.mkdtemp(prefix="lo_profile_", dir=profiles_root)
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def convert_one(src_path: str, out_dir: str, rel_path: str, formats):
+    """Converts one file into every requested format; runs in a pool worker."""
+    started = time.perf_counter()
+    timings = {}
+    result = {"file": rel_path, "status": "converted", "questions": 0, "error": None}
+    try:
+        attachments = {}
+        questions = converter.convert(src_path, timings=timings, attachments=attachments)
+        result["questions"] = len(questions)
+        if not questions:
+            result["status"] = "empty"
+
+        for fmt in formats:
+            start = time.perf_counter()
+            data = converter.render(questions, fmt, attachments)
+            timings[f"format_{fmt}"] = time.perf_counter() - start
+            _write_atomic(os.path.join(out_dir, output_name(rel_path, fmt)), data)
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+
+    result["seconds"] = time.perf_counter() - started
+    result["timings"] = timings
+    return result
+
+
+def write_report(path: str, rows: list):
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "status", "questions", "seconds", *STAGES, "error"])
+            for r in rows:
+                timings = r.get("timings", {})
+                writer.writerow([
+                    r["file"], r["status"], r.get("questions", ""), f"{r.get('seconds', 0):.3f}",
+                    *(f"{timings[s]:.3f}" if s in timings else "" for s in STAGES),
+                    r.get("error") or "",
+                ])
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"files": rows}, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("src_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument("--format", default="gift", help=f"any of {', '.join(FORMATS)}, comma separated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--report", default=None, help="report path (default OUT_DIR/bulk_report.json)")
+    parser.add_argument("--force", action="store_true", help="convert even up-to-date files")
+    args = parser.parse_args()
+
+    formats = [f for f in args.format.split(",") if f]
+    for f in formats:
+        if f not in FORMATS:
+            parser.error(f"unknown format: {f}")
+    if not os.path.isdir(args.src_dir):
+        parser.error(f"not a directory: {args.src_dir}")
+    os.makedirs(args.out_dir, exist_ok=True)
+    report_path = args.report or os.path.join(args.out_dir, "bulk_report.json")
+
+    state = load_state(args.out_dir)
+    rows = []
+    pending = {}
+    for rel_path in find_sources(args.src_dir):
+        src_path = os.path.join(args.src_dir, rel_path)
+        current, sha256 = (False, None) if args.force else up_to_date(
+            src_path, args.out_dir, rel_path, formats, state.get(rel_path))
+        if current:
+            rows.append({"file": rel_path, "status": "skipped", "questions": state[rel_path].get("questions")})
+            # Refresh mtime so the next run takes the stat-only path again
+            stat = os.stat(src_path)
+            state[rel_path].update(mtime=stat.st_mtime, size=stat.st_size)
+        else:
+            pending[rel_path] = sha256
+
+    print(f"{len(pending)} to convert, {len(rows)} up to date, {args.workers} worker(s)")
+    started = time.perf_counter()
+    profiles_root = tempfile.mkdtemp(prefix="bulk_convert_profiles_")
+    unsaved, saved_at = 0, time.monotonic()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=_init_worker,
+                                 initargs=(profiles_root,)) as pool:
+            futures = {
+                pool.submit(convert_one, os.path.join(args.src_dir, rel), args.out_dir, rel, formats): rel
+                for rel in pending
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                rel_path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker itself died (import error, crash in native code)
+                    result = {"file": rel_path, "status": "error", "questions": 0, "error": repr(e), "seconds": 0.0}
+                rows.append(result)
+                print(f"[{done}/{len(futures)}] {result['status']:<9} {result['seconds']:7.2f}s  {rel_path}"
+                      + (f"  ({result['error']})" if result["error"] else ""))
+                if result["status"] != "error":
+                    src_path = os.path.join(args.src_dir, rel_path)
+                    stat = os.stat(src_path)
+                    state[rel_path] = {
+                        "mtime": stat.st_mtime,
+                        "size": stat.st_size,
+                        "sha256": pending[rel_path] or file_sha256(src_path),
+                        "formats": sorted(set(formats) | set(state.get(rel_path, {}).get("formats", ()))),
+                        "questions": result["questions"],
+                    }
+                    unsaved += 1
+                # Saved as we go so an interrupted run keeps most of its progress
+                if unsaved and (unsaved >= STATE_SAVE_EVERY_FILES
+                                or time.monotonic() - saved_at >= STATE_SAVE_EVERY_SECONDS):
+                    save_state(args.out_dir, state)
+                    unsaved, saved_at = 0, time.monotonic()
+    finally:
+        shutil.rmtree(profiles_root, ignore_errors=True)
+    save_state(args.out_dir, state)
+
+    rows.sort(key=lambda r: r["file"])
+    write_report(report_path, rows)
+    errors = sum(1 for r in rows if r["status"] == "error")
+    print(f"done in {time.perf_counter() - started:.1f}s: "
+          f"{len(rows) - errors} ok, {errors} failed; report written to {report_path}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Startup-time budget check.
+
+Imports main in a fresh interpreter several times and fails (exit code 1)
+when the median import + create_app() time exceeds the budget, when the
+import opened a database connection, or when a module that should load
+lazily was imported. The conversion engine (converter.py) is checked the
+same way on its own: it has a budget of its own and must not pull in the
+web framework, the database driver or any conversion-time dependency.
+Finally a page and a real /static file are fetched through the app
+(without the lifespan, so no database): both must come back 200 gzipped
+and 304 when revalidated with their ETag:
+
+    python check_startup.py
+    python check_startup.py --budget-ms 800 --runs 7
+    python check_startup.py --lifespan      # also time the lifespan (needs Postgres)
+
+Run it in CI next to the benchmark so startup regressions are caught early.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Loaded on first use (first login, first email, first conversion, first receipt)
+LAZY_MODULES = ["bs4", "passlib", "smtplib", "PIL"]
+# Never needed by `import converter`
+CONVERTER_EXCLUDED_MODULES = LAZY_MODULES + [
+    "fastapi", "psycopg2", "pydantic", "storage", "main",
+    "xml.etree.ElementTree", "xml.sax.saxutils", "difflib", "subprocess",
+]
+
+CONVERTER_PROBE = r"""
+import json, sys, time
+start = time.perf_counter()
+import converter
+result = {
+    "import_ms": (time.perf_counter() - start) * 1000,
+    "loaded": [m for m in EXCLUDED if m in sys.modules],
+}
+print(json.dumps(result))
+"""
+
+PROBE = r"""
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+created = time.perf_counter()
+result = {
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "db_connections": sum(main.DB_CONNECTIONS_OPENED._values.values()),
+    "lazy_loaded": [m for m in LAZY_MODULES if m in sys.modules],
+}
+if WITH_LIFESPAN:
+    import asyncio
+    app = main.create_app()
+    async def run():
+        t = time.perf_counter()
+        async with app.router.lifespan_context(app):
+            return (time.perf_counter() - t) * 1000
+    result["lifespan_ms"] = asyncio.run(run())
+print(json.dumps(result))
+"""
+
+# Needs httpx (Starlette's TestClient); the lifespan is not entered
+ASSETS_PROBE = r"""
+import json
+from starlette.testclient import TestClient
+import main
+client = TestClient(main.create_app())
+result = {}
+for path in PATHS:
+    first = client.get(path, headers={"Accept-Encoding": "gzip"})
+    again = client.get(path, headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers.get("etag", "")})
+    result[path] = [first.status_code, first.headers.get("content-encoding"), again.status_code]
+print(json.dumps(result))
+"""
+ASSET_PATHS = ["/login", "/static/index.html"]
+
+
+def probe(with_lifespan: bool):
+    return run_probe(f"LAZY_MODULES = {LAZY_MODULES!r}\nWITH_LIFESPAN = {with_lifespan!r}\n" + PROBE)
+
+
+def assets_probe():
+    return run_probe(f"PATHS = {ASSET_PATHS!r}\n" + ASSETS_PROBE)
+
+
+def converter_probe():
+    return run_probe(f"EXCLUDED = {CONVERTER_EXCLUDED_MODULES!r}\n" + CONVERTER_PROBE)
+
+
+def run_probe(code: str):
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", 1500)),
+                        help="median import + create_app() budget")
+    parser.add_argument("--converter-budget-ms", type=float, default=float(os.getenv("CONVERTER_BUDGET_MS", 100)),
+                        help="median `import converter` budget")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--lifespan", action="store_true", help="also time the lifespan startup")
+    args = parser.parse_args()
+
+    results = [probe(args.lifespan) for _ in range(args.runs)]
+    total = statistics.median(r["import_ms"] + r["create_app_ms"] for r in results)
+    print(f"import:     {statistics.median(r['import_ms'] for r in results):8.1f} ms")
+    print(f"create_app: {statistics.median(r['create_app_ms'] for r in results):8.1f} ms")
+    if args.lifespan:
+        print(f"lifespan:   {statistics.median(r['lifespan_ms'] for r in results):8.1f} ms")
+    print(f"total:      {total:8.1f} ms (budget {args.budget_ms:.0f} ms)")
+    converter_results = [converter_probe() for _ in range(args.runs)]
+    converter_ms = statistics.median(r["import_ms"] for r in converter_results)
+    print(f"converter:  {converter_ms:8.1f} ms (budget {args.converter_budget_ms:.0f} ms)")
+
+    failures = []
+    if total > args.budget_ms:
+        failures.append(f"startup took {total:.1f} ms, over the {args.budget_ms:.0f} ms budget")
+    if any(r["db_connections"] for r in results):
+        failures.append("importing main opened a database connection")
+    lazy = sorted({m for r in results for m in r["lazy_loaded"]})
+    if lazy:
+        failures.append(f"imported at startup instead of on first use: {', '.join(lazy)}")
+    if converter_ms > args.converter_budget_ms:
+        failures.append(f"importing converter took {converter_ms:.1f} ms, over the {args.converter_budget_ms:.0f} ms budget")
+    pulled_in = sorted({m for r in converter_results for m in r["loaded"]})
+    if pulled_in:
+        failures.append(f"importing converter also imported: {', '.join(pulled_in)}")
+
+    for path, (status, encoding, revalidated) in assets_probe().items():
+        print(f"{path}: {status} {encoding or 'identity'}, revalidated {revalidated}")
+        if status != 200 or encoding != "gzip" or revalidated != 304:
+            failures.append(f"{path} answered {status} ({encoding or 'identity'}), then {revalidated} on revalidation; "
+                            "expected 200 (gzip), then 304")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,679 @@
+"""
+The conversion engine: Word question tables in, question dicts and rendered
+GIFT / Hemis / Moodle XML out.
+
+    import converter
+    questions = converter.convert("fizika.docx")            # path ...
+    questions = converter.convert(data, filename="x.docx")  # ... or bytes
+    gift = converter.render(questions, "gift")              # bytes
+
+No database, web framework or storage imports, and everything only some
+calls need (BeautifulSoup, ElementTree, the XML writer, subprocess for the
+office export) is imported on first use. Importing this module takes
+around 15 ms, nearly all of it the standard library modules below;
+check_startup.py holds it under CONVERTER_BUDGET_MS. main.py (web app and
+workers), bulk_convert.py and benchmark.py all run conversions through it.
+"""
+import os
+import re
+import io
+import json
+import time
+import base64
+import hashlib
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# output_format -> (file extension, media type)
+OUTPUT_FORMATS = {
+    "gift": ("txt", "text/plain"),
+    "hemis": ("txt", "text/plain"),
+    "moodlexml": ("xml", "application/xml"),
+}
+
+# --- Office Export and Extraction ---
+
+def export_to_html(temp_input_path: str, base_dir: str):
+    """
+    Runs the office export (MS Word on Windows, LibreOffice elsewhere) and
+    returns the path of the produced HTML file.
+    """
+    import platform
+    import subprocess
+
+    filename = os.path.splitext(os.path.basename(temp_input_path))[0]
+
+    # We target .htm or .html in the temp dir
+    htm_path = os.path.join(base_dir, f"{filename}.htm")
+    html_path = os.path.join(base_dir, f"{filename}.html")
+
+    current_os = platform.system()
+    
+    if current_os == "Windows":
+        try:
+            import pythoncom
+            import win32com.client
+            
+            pythoncom.CoInitialize()
+            word = None
+            try:
+                # Use EnsureDispatch for better stability
+                try:
+                    word = win32com.client.gencache.EnsureDispatch("Word.Application")
+                except:
+                    word = win32com.client.Dispatch("Word.Application")
+                    
+                word.Visible = False
+                word.DisplayAlerts = 0 
+                
+                # Open ReadOnly from temp path
+                doc = word.Documents.Open(FileName=temp_input_path, ReadOnly=True, Visible=False)
+
+                # --- IMPOROVE IMAGE QUALITY ---
+                # Configure WebOptions for better resolution and PNG support
+                try:
+                    doc.WebOptions.AllowPNG = True
+                    doc.WebOptions.PixelsPerInch = 384 # 384 DPI = ~400% of standard 96 DPI
+                except Exception as e:
+                    logger.warning(f"Could not set WebOptions: {e}")
+                # ------------------------------
+                
+                # Handle Protected View if it occurs (though unlikely in temp)
+                if word.ProtectedViewWindows.Count > 0:
+                     try:
+                         pv = word.ProtectedViewWindows(1)
+                         doc = pv.Edit()
+                     except:
+                         pass
+
+                # Use SaveAs2 for better compatibility
+                htm_path = os.path.normpath(htm_path)
+                doc.SaveAs2(FileName=htm_path, FileFormat=10) # 10 = wdFormatFilteredHTML
+                doc.Close(SaveChanges=False)
+            except Exception as e:
+                logger.error(f"Error automating Word: {e}")
+                raise e
+            finally:
+                if word:
+                    try:
+                        word.Quit()
+                    except:
+                        pass
+                pythoncom.CoUninitialize()
+        except ImportError:
+            logger.error("win32com not found. Please install pywin32.")
+            raise Exception("Windows conversion requires 'pywin32' library.")
+
+    else:
+        # Linux / MacOS Logic (LibreOffice)
+        logger.info("Running on non-Windows OS. Trying LibreOffice...")
+        try:
+            cmd = [
+                "libreoffice", 
+                "--headless", 
+                "--convert-to", 
+                "html", 
+                "--outdir", 
+                base_dir, 
+                temp_input_path
+            ]
+            # Concurrent soffice processes must not share a user profile;
+            # parallel callers (bulk_convert.py workers) give each their own
+            profile_dir = os.getenv("LIBREOFFICE_PROFILE_DIR")
+            if profile_dir:
+                cmd.insert(1, f"-env:UserInstallation=file://{os.path.abspath(profile_dir)}")
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            
+            if os.path.exists(html_path):
+                htm_path = html_path
+                
+        except Exception as e:
+            logger.error(f"LibreOffice conversion failed: {e}")
+            raise Exception("LibreOffice conversion failed. Ensure 'libreoffice' is installed.")
+
+    if not os.path.exists(htm_path) and not os.path.exists(html_path):
+        raise Exception("HTML file was not created.")
+        
+    return htm_path if os.path.exists(htm_path) else html_path
+
+def parse_html(html_path: str):
+    from bs4 import BeautifulSoup
+    with open(html_path, "rb") as f:
+        return BeautifulSoup(f, "html.parser")
+
+def clean_text(soup):
+    """Strips stray symbols and escapes angle brackets in text nodes, in place."""
+    for text_node in soup.find_all(string=True):
+        if text_node.parent.name in ['script', 'style', 'title', 'meta']:
+            continue
+        if text_node.parent.name == 'span' and 'white-space: nowrap' in str(text_node.parent.get('style', '')):
+             continue
+
+        original_text = str(text_node)
+        new_text = original_text.replace("ù", "")
+        if "<" in new_text: new_text = new_text.replace("<", "&lt;")
+        if ">" in new_text: new_text = new_text.replace(">", "&gt;")
+        
+        # Note: We delay GIFT/Hemis specific escaping to the formatter level ideally, 
+        # but current logic does it here. For Hemis, {}~= might be fine, but GIFT needs escaping.
+        # For now, let's keep basic cleaning here, but move format-specific escaping if we can.
+        # Actually, the user's current code does GIFT escaping IN PLACE. 
+        # We should probably run escaping only if format is GIFT, or unescape for Hemis.
+        # To keep it simple, I will keep the cleaning but remove the explicit GIFT escaping from here
+        # and move it to the gift_block function.
+        
+        if new_text != original_text:
+            text_node.replace_with(new_text)
+
+def encode_images(soup, base_dir: str, files_dir: str, attachments: Optional[dict] = None):
+    """
+    Inlines every <img> as a base64 data URI, in place. When `attachments` is
+    given, image bytes are collected into it instead (named by content hash,
+    so a repeated image is stored once) and the tag points at
+    @@PLUGINFILE@@/<name>, as Moodle XML expects.
+    """
+    img_tags = soup.find_all("img")
+    for img in img_tags:
+        src = img.get("src")
+        if not src: continue
+        
+        # Image paths are relative to base_dir (temp_dir)
+        image_full_path = os.path.join(base_dir, src)
+        if not os.path.exists(image_full_path):
+            possible_name = os.path.basename(src)
+            possible_path = os.path.join(files_dir, possible_name)
+            if os.path.exists(possible_path):
+                image_full_path = possible_path
+
+        if os.path.exists(image_full_path):
+            try:
+                with open(image_full_path, "rb") as img_file:
+                    raw_data = img_file.read()
+                    
+                    mime_type = "image/png"
+                    if image_full_path.lower().endswith((".jpg", ".jpeg")):
+                        mime_type = "image/jpeg"
+                    elif image_full_path.lower().endswith(".gif"):
+                         mime_type = "image/gif"
+                    
+                    if attachments is not None:
+                        name = f"{hashlib.sha1(raw_data).hexdigest()[:16]}.{mime_type.split('/')[1]}"
+                        attachments[name] = raw_data
+                        img['src'] = f"@@PLUGINFILE@@/{name}"
+                    else:
+                        # Encode Base64
+                        encoded_string = base64.b64encode(raw_data).decode("utf-8").replace("\n", "").replace("\r", "")
+                        
+                        # Generate clean HTML tag
+                        # gift_block will automatically escape '=' to '\=' later if needed
+                        # hemis_block will leave it as is
+                        img['src'] = f"data:{mime_type};base64,{encoded_string}"
+                    
+                    # CRITICAL FIX: Convert the Tag object to a String representation.
+                    # The subsequent questions extraction uses .get_text(), which ignores Tags.
+                    # By converting to string, we ensure the <img> code is treated as text and preserved.
+                    img.replace_with(str(img))
+            except Exception as e:
+                logger.warning(f"Could not encode image: {e}")
+
+def question_from_cells(texts: list):
+    """Builds a question from one row's cell texts (No | Question | Correct | Distractors...), or None."""
+    if len(texts) < 3:
+        return None
+
+    question_text = texts[1]
+    correct_answer = texts[2]
+    
+    if not question_text and not correct_answer:
+        return None
+
+    # Skip header rows
+    q_lower = question_text.lower()
+    if "savol" in q_lower or "question" in q_lower or "to'g'ri javob" in q_lower:
+        return None
+        
+    return {
+        "question": question_text,
+        "correct": correct_answer,
+        "distractors": [t for t in texts[3:] if t]
+    }
+
+def extract_questions(soup):
+    """Reads question rows (No | Question | Correct | Distractors...) from every table."""
+    questions = []
+    tables = soup.find_all("table")
+    
+    def get_cell_text(cell):
+        text = cell.get_text(separator=' ', strip=True)
+        text = re.sub(r'\s+', ' ', text)
+        return text
+
+    for table in tables:
+        rows = table.find_all("tr")
+        for row in rows:
+            cells = row.find_all(["td", "th"])
+            question = question_from_cells([get_cell_text(c) for c in cells])
+            if question:
+                questions.append(question)
+
+    return questions
+
+# --- Fast .docx Extraction ---
+# Plain-text question tables can be read straight from word/document.xml,
+# skipping the office export (which alone takes a second or more). Anything
+# the export would render differently (images, drawings, equations, symbol
+# fonts, merged or nested cells) makes fast_docx_questions() return None so
+# the caller uses the full pipeline instead.
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_FAST_PATH_BLOCKERS = (
+    "<w:drawing", "<w:pict", "<w:object", "<w:sym", "<w:vMerge", "<m:oMath",
+    "<mc:AlternateContent", "<v:shape", "<w:altChunk", "<w:subDoc", "<w:sdt",
+)
+
+def _docx_cell_text(cell):
+    """The cell text as the HTML path would extract it, or None when that can't be known here."""
+    paragraphs = []
+    for p in cell.iter(f"{W_NS}p"):
+        # The export turns each formatted run into its own element, and
+        # get_cell_text() joins elements with a space ("Hel<b>lo</b>" reads
+        # "Hel lo"). Whether two runs stay apart depends on the exporter, so
+        # only single-run paragraphs are read here.
+        runs = [r for r in p.iter(f"{W_NS}r") if any(t.text for t in r.iter(f"{W_NS}t"))]
+        if len(runs) > 1:
+            return None
+        parts = []
+        for node in p.iter():
+            if node.tag == f"{W_NS}t" and node.text:
+                parts.append(node.text)
+            elif node.tag in (f"{W_NS}tab", f"{W_NS}br", f"{W_NS}cr"):
+                parts.append(" ")
+        paragraphs.append("".join(parts))
+    # Same cleanup clean_text() + get_cell_text() apply to the exported HTML
+    text = " ".join(paragraphs).replace("ù", "").replace("<", "&lt;").replace(">", "&gt;")
+    return re.sub(r'\s+', ' ', text).strip()
+
+def fast_docx_questions(docx_path: str):
+    """Questions read directly from a .docx, or None when the fast path does not apply."""
+    import zipfile
+    import xml.etree.ElementTree as ET
+
+    try:
+        with zipfile.ZipFile(docx_path) as z:
+            xml_bytes = z.read("word/document.xml")
+    except (zipfile.BadZipFile, KeyError):
+        return None
+
+    xml_text = xml_bytes.decode("utf-8", "replace")
+    if any(marker in xml_text for marker in DOCX_FAST_PATH_BLOCKERS):
+        return None
+
+    body = ET.fromstring(xml_bytes).find(f"{W_NS}body")
+    if body is None:
+        return None
+
+    questions = []
+    for table in body.iter(f"{W_NS}tbl"):
+        for row in table.findall(f"{W_NS}tr"):
+            cells = row.findall(f"{W_NS}tc")
+            if any(c.find(f".//{W_NS}tbl") is not None for c in cells):
+                return None  # nested tables
+            texts = [_docx_cell_text(c) for c in cells]
+            if None in texts:
+                return None  # formatted runs: let the office export decide the spacing
+            question = question_from_cells(texts)
+            if question:
+                questions.append(question)
+    return questions
+
+def questions_from_html(html_path: str, base_dir: str, files_dir: str, timings: Optional[dict] = None, attachments: Optional[dict] = None):
+    """HTML parse -> text cleanup -> image encoding -> extraction; records stage timings if asked."""
+    def timed(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        if timings is not None:
+            timings[name] = time.perf_counter() - start
+        return result
+
+    soup = timed("html_parse", parse_html, html_path)
+    timed("text_cleanup", clean_text, soup)
+    timed("image_encoding", encode_images, soup, base_dir, files_dir, attachments)
+    return timed("extraction", extract_questions, soup)
+
+def convert_to_gift(input_path: str, output_path: str, output_format: str = 'gift', timings: Optional[dict] = None, attachments: Optional[dict] = None):
+    """
+    Converts Word Doc/Docx -> Filtered HTML -> Extract Questions
+    Supports Windows (MS Word) and Linux (LibreOffice).
+    Pass a dict as `timings` to collect per-stage durations in seconds, and
+    as `attachments` to get images as files instead of data URIs.
+    """
+    import uuid
+    import shutil
+
+    abs_input_path = os.path.abspath(input_path)
+    
+    # Create a local temp directory in the project folder to ensure Word can access it (avoiding AppData or Temp restrictions)
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    temp_work_dir = os.path.join(project_root, "temp_conversion")
+    os.makedirs(temp_work_dir, exist_ok=True)
+    
+    # Create a unique subdir for this job
+    job_temp_dir = os.path.join(temp_work_dir, f"job_{uuid.uuid4()}")
+    os.makedirs(job_temp_dir, exist_ok=True)
+
+    try:
+        # Copy input file to temp dir
+        filename_ext = os.path.basename(abs_input_path)
+        filename = os.path.splitext(filename_ext)[0]
+        temp_input_path = os.path.join(job_temp_dir, filename_ext)
+        shutil.copy2(abs_input_path, temp_input_path)
+        
+        files_dir = os.path.join(job_temp_dir, f"{filename}_files")
+
+        start = time.perf_counter()
+        actual_htm_path = export_to_html(temp_input_path, job_temp_dir)
+        if timings is not None:
+            timings["office_export"] = time.perf_counter() - start
+
+        return questions_from_html(actual_htm_path, job_temp_dir, files_dir, timings, attachments)
+
+    except Exception as e:
+        logger.error(f"Conversion process failed: {e}")
+        raise e
+    finally:
+        # Cleanup
+        try:
+            if os.path.exists(job_temp_dir):
+                shutil.rmtree(job_temp_dir)
+        except Exception as ignored:
+            logger.warning(f"Failed to cleanup temp dir: {ignored}")
+
+def escape_gift(text):
+    t = text.replace("{", "\\{").replace("}", "\\}").replace("=", "\\=").replace("~", "\\~")
+    return t
+
+def gift_block(q):
+    block = []
+    block.append(f"::{escape_gift(q['question'])}{{")
+    block.append(f"={escape_gift(q['correct'])}")
+    for d in q['distractors']:
+        block.append(f"~{escape_gift(d)}")
+    block.append("}")
+    return "\n".join(block)
+
+def hemis_block(q):
+    # Hemis format:
+    # Question
+    # ====
+    # #Correct
+    # ====
+    # Wrong
+    # ====
+    # Wrong
+    #
+    # ++++
+    #
+    
+    block = []
+    block.append(q['question'])
+    block.append("====")
+    block.append(f"#{q['correct']}")
+    block.append("====")
+    for i, d in enumerate(q['distractors']):
+        block.append(d)
+        if i < len(q['distractors']) - 1:
+            block.append("====")
+    
+    # Add separator + blank lines
+    block.append("")
+    block.append("++++")
+    block.append("")
+    return "\n".join(block)
+
+# Moodle XML: images travel as <file> elements next to the text that uses
+# them instead of data URIs, which keeps the text small and sidesteps GIFT
+# escaping entirely. Written with a streaming XML writer.
+
+PLUGINFILE_REF = re.compile(r"@@PLUGINFILE@@/([\w.-]+)")
+XML_INVALID_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def plain_text(text: str) -> str:
+    """Cell HTML as plain words: tags dropped, entities decoded, whitespace collapsed."""
+    import html
+    return " ".join(html.unescape(re.sub(r"<[^>]+>", " ", text)).split())
+
+def _question_name(text: str, number: int):
+    return plain_text(text)[:60] or f"Savol {number}"
+
+def _write_text_element(xml, tag: str, attrs: dict, text: str, attachments: dict):
+    """<tag><text>..</text><file/>..</tag>, each referenced image once per element."""
+    xml.startElement(tag, attrs)
+    xml.startElement("text", {})
+    xml.characters(XML_INVALID_CHARS.sub("", text))
+    xml.endElement("text")
+    for name in dict.fromkeys(PLUGINFILE_REF.findall(text)):
+        data = attachments.get(name)
+        if data is None:
+            continue
+        xml.startElement("file", {"name": name, "path": "/", "encoding": "base64"})
+        xml.characters(base64.b64encode(data).decode("ascii"))
+        xml.endElement("file")
+    xml.endElement(tag)
+
+def _write_moodlexml_question(xml, q, number: int, attachments: dict):
+    xml.ignorableWhitespace("\n  ")
+    xml.startElement("question", {"type": "multichoice"})
+    xml.startElement("name", {})
+    xml.startElement("text", {})
+    xml.characters(XML_INVALID_CHARS.sub("", _question_name(q['question'], number)))
+    xml.endElement("text")
+    xml.endElement("name")
+    _write_text_element(xml, "questiontext", {"format": "html"}, q['question'], attachments)
+    for tag, value in (("defaultgrade", "1"), ("single", "true"), ("shuffleanswers", "true"), ("answernumbering", "abc")):
+        xml.startElement(tag, {})
+        xml.characters(value)
+        xml.endElement(tag)
+    _write_text_element(xml, "answer", {"fraction": "100", "format": "html"}, q['correct'], attachments)
+    for d in q['distractors']:
+        _write_text_element(xml, "answer", {"fraction": "0", "format": "html"}, d, attachments)
+    xml.endElement("question")
+
+def write_moodlexml(questions, attachments: dict, out):
+    """Streams a Moodle XML quiz of multichoice questions to the binary file `out`."""
+    from xml.sax.saxutils import XMLGenerator
+    xml = XMLGenerator(out, encoding="utf-8", short_empty_elements=True)
+    xml.startDocument()
+    xml.startElement("quiz", {})
+    for number, q in enumerate(questions, 1):
+        _write_moodlexml_question(xml, q, number, attachments)
+    xml.ignorableWhitespace("\n")
+    xml.endElement("quiz")
+    xml.endDocument()
+
+def moodlexml_question_bytes(q, number: int, attachments: dict) -> bytes:
+    """One <question> element as write_moodlexml would emit it inside <quiz>."""
+    from xml.sax.saxutils import XMLGenerator
+    buf = io.BytesIO()
+    _write_moodlexml_question(XMLGenerator(buf, encoding="utf-8", short_empty_elements=True), q, number, attachments)
+    return buf.getvalue()
+
+# --- Rendering ---
+# Text formats are rendered block by block so a re-conversion can copy the
+# blocks of unchanged rows out of an earlier output (`previous`, a
+# (row manifest, output text) pair) instead of formatting them again.
+ROW_DIFF_MAX_LISTED = 50
+
+# output_format -> (block formatter, text between blocks, text after the last block)
+TEXT_LAYOUTS = {
+    "gift": (gift_block, "\n\n", "\n"),
+    "hemis": (hemis_block, "\n", ""),
+}
+
+def row_fingerprint(q) -> str:
+    raw = json.dumps([q['question'], q['correct'], q['distractors']], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def inline_images(q, attachments: dict, encoded: dict):
+    """The question with @@PLUGINFILE@@ references turned into data URIs (cached in `encoded`)."""
+    def data_uri(match):
+        name = match.group(1)
+        if name not in encoded:
+            data = attachments.get(name)
+            if data is None:
+                return match.group(0)
+            mime_type = "image/" + name.rsplit(".", 1)[-1]
+            encoded[name] = f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+        return encoded[name]
+
+    def sub(text):
+        return PLUGINFILE_REF.sub(data_uri, text)
+
+    return {"question": sub(q['question']), "correct": sub(q['correct']), "distractors": [sub(d) for d in q['distractors']]}
+
+def row_manifest(questions, output_format: str) -> dict:
+    """A row manifest without block offsets, for outputs whose blocks can't be reused (Moodle XML, parts)."""
+    return {"format": output_format, "rows": [[row_fingerprint(q), None, None] for q in questions]}
+
+def render_rows(questions, attachments: dict, output_format: str, previous=None):
+    """
+    Formats `questions`, reusing blocks of identical rows from `previous` (as
+    returned by load_previous_rows). Returns (content bytes, row manifest,
+    number of reused blocks).
+    """
+    if output_format not in TEXT_LAYOUTS:
+        buf = io.BytesIO()
+        write_moodlexml(questions, attachments, buf)
+        return buf.getvalue(), row_manifest(questions, output_format), 0
+
+    manifest = {"format": output_format, "rows": []}
+
+    _, separator, trailer = TEXT_LAYOUTS[output_format]
+    parts = []
+    reused = 0
+    pos = 0
+    for fp, block, hit in iter_text_blocks(questions, attachments, output_format, previous):
+        reused += hit
+        manifest["rows"].append([fp, pos, pos + len(block)])
+        parts.append(block)
+        pos += len(block) + len(separator)
+    content = separator.join(parts) + (trailer if parts else "")
+    return content.encode("utf-8"), manifest, reused
+
+def iter_text_blocks(questions, attachments: dict, output_format: str, previous=None):
+    """Yields (fingerprint, block, reused) per question for GIFT / Hemis, taking unchanged blocks from `previous`."""
+    block_of = TEXT_LAYOUTS[output_format][0]
+    cached = {}
+    if previous and previous[1] is not None:
+        old_manifest, old_text = previous
+        cached = {fp: old_text[start:end] for fp, start, end in old_manifest["rows"] if start is not None}
+
+    encoded = {}
+    for q in questions:
+        fp = row_fingerprint(q)
+        block = cached.get(fp)
+        if block is None:
+            yield fp, block_of(inline_images(q, attachments, encoded)), False
+        else:
+            yield fp, block, True
+
+def diff_rows(old: list, new: list) -> dict:
+    """Compares two fingerprint lists; row numbers refer to the new document (1-based)."""
+    import difflib
+    summary = {"unchanged": 0, "added": 0, "changed": 0, "removed": 0, "added_rows": [], "changed_rows": []}
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            summary["unchanged"] += i2 - i1
+            continue
+        # A replaced run pairs old and new rows up as edits; the rest are adds/removes
+        paired = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+        summary["changed"] += paired
+        summary["changed_rows"].extend(range(j1 + 1, j1 + paired + 1))
+        summary["removed"] += (i2 - i1) - paired
+        summary["added"] += (j2 - j1) - paired
+        summary["added_rows"].extend(range(j1 + paired + 1, j2 + 1))
+    summary["added_rows"] = summary["added_rows"][:ROW_DIFF_MAX_LISTED]
+    summary["changed_rows"] = summary["changed_rows"][:ROW_DIFF_MAX_LISTED]
+    return summary
+
+# Split output (see write_parts): output_format -> (part header, text between questions, part footer)
+PART_LAYOUTS = {
+    "gift": (b"", b"\n\n", b"\n"),
+    "hemis": (b"", b"\n", b""),
+    "moodlexml": (b'<?xml version="1.0" encoding="utf-8"?>\n<quiz>', b"", b"\n</quiz>"),
+}
+
+def write_parts(questions, attachments: dict, output_format: str, previous, max_bytes: Optional[int], max_questions: Optional[int], put_part):
+    """
+    Writes the output as numbered parts through put_part(number, data). A
+    question larger than max_bytes on its own still gets a part of its own.
+    Returns (row manifest, reused blocks, number of parts, total bytes).
+    """
+    header, separator, footer = PART_LAYOUTS[output_format]
+    if output_format in TEXT_LAYOUTS:
+        blocks = ((fp, block.encode("utf-8"), hit)
+                  for fp, block, hit in iter_text_blocks(questions, attachments, output_format, previous))
+    else:
+        blocks = ((row_fingerprint(q), moodlexml_question_bytes(q, number, attachments), False)
+                  for number, q in enumerate(questions, 1))
+
+    manifest = {"format": output_format, "rows": []}
+    reused = parts = total = 0
+    current, size = [], len(header) + len(footer)
+
+    def flush():
+        nonlocal parts, total
+        data = header + separator.join(current) + footer
+        parts += 1
+        total += len(data)
+        put_part(parts, data)
+
+    for fp, block, hit in blocks:
+        reused += hit
+        # Offsets only make sense in a single output file
+        manifest["rows"].append([fp, None, None])
+        added = len(block) + (len(separator) if current else 0)
+        if current and ((max_questions and len(current) >= max_questions) or (max_bytes and size + added > max_bytes)):
+            flush()
+            current, size = [], len(header) + len(footer)
+            added = len(block)
+        current.append(block)
+        size += added
+    if current or not parts:
+        flush()
+    return manifest, reused, parts, total
+
+# --- Public API ---
+def convert(source, filename: Optional[str] = None, timings: Optional[dict] = None, attachments: Optional[dict] = None):
+    """
+    Questions of a .doc/.docx given as a path or as bytes (`filename` then
+    names the format; .docx is assumed). Plain-text .docx tables are read
+    directly, everything else goes through the office export. Pass dicts as
+    `timings` and `attachments` as for convert_to_gift.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename or "")[1] or ".docx")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(source)
+            return convert(path, timings=timings, attachments=attachments)
+        finally:
+            os.remove(path)
+
+    path = os.fspath(source)
+    if path.lower().endswith(".docx"):
+        start = time.perf_counter()
+        questions = fast_docx_questions(path)
+        if timings is not None:
+            timings["fast_extraction"] = time.perf_counter() - start
+        if questions:
+            return questions
+    return convert_to_gift(path, None, timings=timings, attachments=attachments)
+
+def render(questions, output_format: str = "gift", attachments: Optional[dict] = None) -> bytes:
+    """The output file for `questions` in any of OUTPUT_FORMATS."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return render_rows(questions, attachments or {}, output_format)[0]
@@ -0,0 +1,95 @@
+"""
+Near-duplicate detection for questions with MinHash signatures and LSH.
+
+A question is reduced to a set of shingles (overlapping character 5-grams of
+its normalised plain text, plus one token per embedded image hash). MinHash
+turns that set into NUM_PERM 32-bit integers whose pairwise agreement
+estimates the Jaccard similarity of two sets. LSH cuts the signature into BANDS bands of ROWS
+values; two questions become candidates when any band is identical. With
+16 x 4 a pair at 0.7 similarity is a candidate ~99% of the time and a pair
+at 0.3 ~12%. Candidates are then confirmed against THRESHOLD on the full
+signature, so only a handful of comparisons are made per question however
+large the index.
+
+Pure Python and deterministic: signatures computed by different workers or
+on different days are comparable.
+"""
+import functools
+import hashlib
+import re
+import struct
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+THRESHOLD = 0.7
+SHINGLE_SIZE = 5
+
+_SIGNATURE = struct.Struct(f">{NUM_PERM}I")
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def shingles(text: str, images=()) -> set:
+    """Character n-grams of `text` (lowercased, punctuation folded to spaces), plus one per image name."""
+    text = _NON_WORD.sub(" ", text.lower()).strip()
+    if len(text) <= SHINGLE_SIZE:
+        grams = {text} if text else set()
+    else:
+        grams = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    grams.update(f"img:{name}" for name in images)
+    return grams
+
+
+def signature(shingle_set: set):
+    """MinHash signature (NUM_PERM ints) of a shingle set, or None for an empty set."""
+    if not shingle_set:
+        return None
+    return tuple(map(min, zip(*map(_shingle_hashes, shingle_set))))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _shingle_hashes(shingle: str):
+    # One extendable-output hash gives all NUM_PERM hash values of a shingle
+    # at once; common shingles repeat across questions, hence the cache
+    return _SIGNATURE.unpack(hashlib.shake_128(shingle.encode("utf-8")).digest(_SIGNATURE.size))
+
+
+def similarity(a, b) -> float:
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    return sum(1 for x, y in zip(a, b) if x == y) / NUM_PERM
+
+
+def band_keys(sig) -> list:
+    """(band, bucket) pairs of a signature; bucket is a signed 64-bit int (fits a BIGINT)."""
+    packed = _SIGNATURE.pack(*sig)
+    keys = []
+    for band in range(BANDS):
+        chunk = packed[band * ROWS * 4:(band + 1) * ROWS * 4]
+        bucket = int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "big", signed=True)
+        keys.append((band, bucket))
+    return keys
+
+
+def pack(sig) -> bytes:
+    return _SIGNATURE.pack(*sig)
+
+
+def unpack(data: bytes):
+    return _SIGNATURE.unpack(bytes(data))
+
+
+class LSHIndex:
+    """In-memory LSH index mapping band buckets to the keys added under them."""
+
+    def __init__(self):
+        self._buckets = {}
+
+    def add(self, key, sig):
+        for band_key in band_keys(sig):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def candidates(self, sig) -> set:
+        found = set()
+        for band_key in band_keys(sig):
+            found.update(self._buckets.get(band_key, ()))
+        return found
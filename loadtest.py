@@ -0,0 +1,515 @@
+"""
+End-to-end load test: upload -> status polling -> download.
+
+Virtual users replay what the dashboard does. Guests load /stats, upload,
+poll /status/{job_id} at the frontend's interval and download the result.
+Registered users log in, refresh /api/me, upload with their token, poll,
+download and refresh /api/me again. The run steps through increasing user
+counts and reports throughput and p50/p95/p99 per endpoint for each step,
+plus the step where throughput stops growing (the saturation point):
+
+    python loadtest.py --base-url http://127.0.0.1:8000 --users 5,10,20,40
+    python loadtest.py --spawn-server --workers 1,2,4 --stub-office --seed-accounts 20
+
+--seed-accounts creates verified accounts directly in the local Postgres
+from .env (they need no tariff: file_cost 0, large balance).
+--spawn-server starts uvicorn itself, once per --workers value.
+--stub-office puts a fake `libreoffice` first on the server's PATH that
+turns the generated .docx into HTML without an office suite; use
+--stub-delay to mimic the real export's start-up cost. A spawned server
+gets the upload admission limits lifted (every guest uploads from
+127.0.0.1); answers of 429 are counted as rejected, not as errors.
+
+Results are written as JSON; compare two runs by eye or with jq.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from synthetic_docx import CONTENT_KINDS, make_questions, write_docx
+
+LOADTEST_EMAIL = "loadtest+{}@example.com"
+LOADTEST_PASSWORD = "loadtest-password"
+
+# The dashboard polls /status every second (templates/dashboard.html)
+FRONTEND_POLL_INTERVAL = 1.0
+# Safe to send again when a keep-alive connection drops mid-request
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Admission limits for a spawned server: all virtual guests share one IP, so
+# the per-IP guest limits would turn most uploads into 429. Variables already
+# set in the environment win. GUEST_MAX_PER_HOUR=0 disables the hourly limit.
+SPAWNED_SERVER_LIMITS = {
+    "QUEUE_MAX_DEPTH": "100000",
+    "USER_MAX_IN_FLIGHT": "100000",
+    "GUEST_MAX_IN_FLIGHT": "100000",
+    "GUEST_MAX_PER_HOUR": "0",
+}
+
+STUB_OFFICE = r'''#!{python}
+"""Stand-in for `libreoffice --headless --convert-to html --outdir DIR FILE`."""
+import os, re, sys, time, zipfile
+
+time.sleep(float(os.environ.get("LOADTEST_STUB_DELAY", "0")))
+args = sys.argv[1:]
+outdir = args[args.index("--outdir") + 1]
+src = args[-1]
+name = os.path.splitext(os.path.basename(src))[0]
+files_dir = os.path.join(outdir, name + "_files")
+
+with zipfile.ZipFile(src) as z:
+    doc = z.read("word/document.xml").decode("utf-8")
+    rels = dict(re.findall(r'Id="([^"]+)"[^>]*Target="([^"]+)"', z.read("word/_rels/document.xml.rels").decode("utf-8")))
+    rows = []
+    for tr in re.findall(r"<w:tr>(.*?)</w:tr>", doc, re.S):
+        cells = []
+        for tc in re.findall(r"<w:tc>(.*?)</w:tc>", tr, re.S):
+            # w:t text is already XML-escaped, which is valid HTML as-is
+            html = "<p>" + "".join(re.findall(r"<w:t[^>]*>(.*?)</w:t>", tc, re.S)) + "</p>"
+            for rel in re.findall(r'r:embed="([^"]+)"', tc):
+                target = rels[rel]
+                os.makedirs(files_dir, exist_ok=True)
+                with open(os.path.join(files_dir, os.path.basename(target)), "wb") as f:
+                    f.write(z.read("word/" + target))
+                html += '<p><img src="%s_files/%s"></p>' % (name, os.path.basename(target))
+            cells.append("<td>" + html + "</td>")
+        rows.append("<tr>" + "".join(cells) + "</tr>")
+
+with open(os.path.join(outdir, name + ".html"), "w", encoding="utf-8") as f:
+    f.write('<html><head><meta charset="utf-8"></head><body><table>' + "".join(rows) + "</table></body></html>")
+'''
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        # 429 from admission control: the server shedding load, not failing
+        self.rejected = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint: str, seconds: float, ok: bool, rejected: bool = False):
+        with self.lock:
+            self.samples[endpoint].append(seconds)
+            if rejected:
+                self.rejected[endpoint] += 1
+            elif not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed: float):
+        endpoints = {}
+        total = errors = rejected = 0
+        with self.lock:
+            items = [(k, sorted(v), self.errors[k], self.rejected[k]) for k, v in self.samples.items()]
+        for endpoint, values, errs, rejs in sorted(items):
+            endpoints[endpoint] = {
+                "count": len(values),
+                "errors": errs,
+                "rejected": rejs,
+                "rps": len(values) / elapsed,
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+            if endpoint != "job_e2e":
+                total += len(values)
+                errors += errs
+                rejected += rejs
+        return {
+            "requests": total,
+            "errors": errors,
+            "error_rate": errors / total if total else 0.0,
+            "rejected": rejected,
+            "rejected_rate": rejected / total if total else 0.0,
+            "rps": total / elapsed,
+            "jobs_per_s": endpoints.get("job_e2e", {}).get("count", 0) / elapsed,
+            "endpoints": endpoints,
+        }
+
+
+class Client:
+    """One keep-alive connection per virtual user, like a browser tab."""
+
+    def __init__(self, base_url: str, recorder: Recorder, timeout: float):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.recorder = recorder
+        self.timeout = timeout
+        self.conn = None
+        self.token = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.conn = cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, endpoint: str, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        start = time.perf_counter()
+        status, data = 0, b""
+        for attempt in (1, 2):
+            if self.conn is None:
+                self._connect()
+            sent = False
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                sent = True
+                response = self.conn.getresponse()
+                status, data = response.status, response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # Stale keep-alive connection: reconnect once. A POST that was
+                # sent may already have been handled (an upload charged and
+                # queued), so only idempotent requests are repeated after that.
+                self.conn.close()
+                self.conn = None
+                if attempt == 2 or (sent and method not in IDEMPOTENT_METHODS):
+                    status = 0
+                    break
+        self.recorder.add(endpoint, time.perf_counter() - start, 200 <= status < 400, rejected=status == 429)
+        return status, data
+
+    def json(self, method, path, endpoint, body=None, headers=None):
+        status, data = self.request(method, path, endpoint, body, headers)
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, None
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+
+def multipart(fields: dict, file_field: str, filename: str, content: bytes):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        "Content-Type: application/vnd.openxmlformats-officedocument.wordprocessingml.document\r\n\r\n".encode("utf-8")
+    )
+    parts.append(content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, args, recorder: Recorder, documents, account, stop_event, rnd):
+        super().__init__(daemon=True)
+        self.args = args
+        self.recorder = recorder
+        self.documents = documents
+        self.account = account
+        self.stop_event = stop_event
+        self.rnd = rnd
+        self.client = Client(args.base_url, recorder, args.timeout)
+
+    def think(self):
+        if self.args.think_time:
+            self.stop_event.wait(self.rnd.uniform(0, 2 * self.args.think_time))
+
+    def login(self):
+        status, data = self.client.json(
+            "POST", "/auth/login", "POST /auth/login",
+            {"email": self.account, "password": self.args.password},
+        )
+        if status == 200 and data:
+            self.client.token = data["access_token"]
+
+    def run_job(self):
+        name, content = self.rnd.choice(self.documents)
+        fmt = self.rnd.choice(self.args.formats)
+        body, headers = multipart({"format": fmt}, "file", name, content)
+        started = time.perf_counter()
+        status, data = self.client.json("POST", "/upload", "POST /upload", body, headers)
+        if status != 200 or not data:
+            return
+        job_id = data["job_id"]
+
+        deadline = started + self.args.job_timeout
+        while not self.stop_event.is_set() and time.perf_counter() < deadline:
+            self.stop_event.wait(self.args.poll_interval)
+            status, job = self.client.json("GET", f"/status/{job_id}", "GET /status/{job_id}")
+            if status == 200 and job and job.get("status") in ("completed", "error"):
+                break
+        else:
+            if not self.stop_event.is_set():
+                self.recorder.add("job_e2e", time.perf_counter() - started, False)
+            return
+
+        ok = job.get("status") == "completed"
+        self.recorder.add("job_e2e", time.perf_counter() - started, ok)
+        if ok:
+            self.client.request("GET", f"/download/{job_id}", "GET /download/{job_id}")
+
+    def run(self):
+        try:
+            if self.account:
+                self.login()
+            while not self.stop_event.is_set():
+                if self.client.token:
+                    self.client.request("GET", "/api/me", "GET /api/me")
+                else:
+                    self.client.request("GET", "/stats", "GET /stats")
+                self.think()
+                if self.stop_event.is_set():
+                    break
+                self.run_job()
+                if self.client.token:
+                    # The dashboard refreshes limits after each completed job
+                    self.client.request("GET", "/api/me", "GET /api/me")
+                self.think()
+        finally:
+            self.client.close()
+
+
+def run_step(args, users: int, documents, accounts):
+    recorder = Recorder()
+    stop_event = threading.Event()
+    rnd = random.Random(args.seed + users)
+    vus = []
+    for i in range(users):
+        account = None
+        if accounts and rnd.random() >= args.guest_ratio:
+            account = accounts[i % len(accounts)]
+        vus.append(VirtualUser(args, recorder, documents, account, stop_event, random.Random(rnd.random())))
+
+    start = time.perf_counter()
+    for vu in vus:
+        vu.start()
+        # Spread logins and first uploads over the ramp-up window
+        time.sleep(args.ramp_up / max(users, 1))
+    time.sleep(max(0.0, args.duration - (time.perf_counter() - start)))
+    stop_event.set()
+    for vu in vus:
+        vu.join(args.timeout + args.poll_interval)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def find_saturation(steps, growth: float, max_error_rate: float):
+    """Last step whose job throughput still grew by more than `growth` without errors piling up."""
+    best = None
+    previous = None
+    for step in steps:
+        summary = step["summary"]
+        if summary["error_rate"] > max_error_rate:
+            break
+        if previous is not None and summary["jobs_per_s"] < previous * (1 + growth):
+            break
+        best = step["users"]
+        previous = summary["jobs_per_s"]
+    return best
+
+
+def seed_accounts(count: int, password: str):
+    """Creates (or resets) verified load-test accounts in the local database."""
+    import psycopg2
+    from dotenv import load_dotenv
+    from passlib.context import CryptContext
+
+    load_dotenv()
+    rounds = int(os.getenv("BCRYPT_ROUNDS", 12))
+    pw_hash = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds).hash(password)
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME", "moodle_quiz_db"),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASSWORD", "password"),
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+    )
+    try:
+        cur = conn.cursor()
+        emails = [LOADTEST_EMAIL.format(i) for i in range(count)]
+        for i, email in enumerate(emails):
+            cur.execute("""
+                INSERT INTO users (full_name, email, phone, password_hash, is_verified, balance)
+                VALUES (%s, %s, %s, %s, TRUE, %s)
+                ON CONFLICT (email) DO UPDATE
+                SET password_hash = EXCLUDED.password_hash, is_verified = TRUE,
+                    balance = EXCLUDED.balance, tariff_id = NULL
+            """, (f"Load Test {i}", email, "+998000000000", pw_hash, 10 ** 9))
+        conn.commit()
+        cur.close()
+        return emails
+    finally:
+        conn.close()
+
+
+def write_stub_office(directory: str):
+    path = os.path.join(directory, "libreoffice")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(STUB_OFFICE.replace("{python}", sys.executable, 1))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def wait_for_server(base_url: str, timeout: float):
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=2)
+            conn.request("GET", "/stats")
+            if conn.getresponse().status == 200:
+                return True
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def start_server(args, workers: int, stub_dir):
+    env = dict(os.environ)
+    for name, value in SPAWNED_SERVER_LIMITS.items():
+        env.setdefault(name, value)
+    if stub_dir:
+        env["PATH"] = stub_dir + os.pathsep + env.get("PATH", "")
+        env["LOADTEST_STUB_DELAY"] = str(args.stub_delay)
+    port = urlsplit(args.base_url).port or 8000
+    cmd = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning",
+    ]
+    proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if not wait_for_server(args.base_url, args.startup_timeout):
+        proc.terminate()
+        raise SystemExit(f"Server with {workers} worker(s) did not come up on {args.base_url}")
+    return proc
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def print_step(workers, users, summary):
+    print(f"\nworkers={workers or '?'} users={users}: {summary['rps']:.1f} req/s, "
+          f"{summary['jobs_per_s']:.2f} jobs/s, errors {summary['error_rate']:.1%}, "
+          f"rejected {summary['rejected_rate']:.1%}")
+    print(f"  {'endpoint':<26}{'count':>7}{'err':>6}{'rej':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, s in summary["endpoints"].items():
+        print(f"  {endpoint:<26}{s['count']:>7}{s['errors']:>6}{s['rejected']:>6}"
+              f"{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int_list, default=[5, 10, 20, 40], help="concurrent users per step")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per step")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds to start all users of a step")
+    parser.add_argument("--guest-ratio", type=float, default=0.5, help="share of guests when accounts exist")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean pause between actions, seconds")
+    parser.add_argument("--poll-interval", type=float, default=FRONTEND_POLL_INTERVAL)
+    parser.add_argument("--job-timeout", type=float, default=300.0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request timeout")
+    parser.add_argument("--formats", default="gift,hemis")
+    parser.add_argument("--rows", type=int_list, default=[20, 100], help="questions per generated document")
+    parser.add_argument("--images", type=int, default=10, help="image on every Nth question (0 = none)")
+    parser.add_argument("--content", default="plain", choices=sorted(CONTENT_KINDS))
+    parser.add_argument("--seed-accounts", type=int, default=0, help="create N verified accounts in the local DB")
+    parser.add_argument("--password", default=LOADTEST_PASSWORD)
+    parser.add_argument("--spawn-server", action="store_true", help="start uvicorn for each --workers value")
+    parser.add_argument("--workers", type=int_list, default=[1])
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--stub-office", action="store_true", help="fake libreoffice on the spawned server's PATH")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="seconds the fake export sleeps")
+    parser.add_argument("--saturation-growth", type=float, default=0.10,
+                        help="minimum relative jobs/s gain for a step to count as scaling")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest.json")
+    args = parser.parse_args()
+    args.formats = [f for f in args.formats.split(",") if f]
+    if args.stub_office and not args.spawn_server:
+        parser.error("--stub-office only applies to a server started with --spawn-server")
+
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    try:
+        documents = []
+        for rows in args.rows:
+            path = os.path.join(workdir, f"load_{rows}.docx")
+            write_docx(path, make_questions(rows, 3, args.content, args.images, seed=rows))
+            with open(path, "rb") as f:
+                documents.append((os.path.basename(path), f.read()))
+
+        accounts = seed_accounts(args.seed_accounts, args.password) if args.seed_accounts else []
+        stub_dir = None
+        if args.stub_office:
+            stub_dir = os.path.join(workdir, "bin")
+            os.makedirs(stub_dir)
+            write_stub_office(stub_dir)
+
+        runs = []
+        for workers in (args.workers if args.spawn_server else [None]):
+            proc = start_server(args, workers, stub_dir) if args.spawn_server else None
+            try:
+                if not proc and not wait_for_server(args.base_url, 5):
+                    raise SystemExit(f"No server answering on {args.base_url}")
+                steps = []
+                for users in args.users:
+                    summary = run_step(args, users, documents, accounts)
+                    print_step(workers, users, summary)
+                    steps.append({"users": users, "summary": summary})
+            finally:
+                if proc:
+                    stop_server(proc)
+            saturation = find_saturation(steps, args.saturation_growth, args.max_error_rate)
+            print(f"\nworkers={workers or '?'}: throughput saturates at {saturation} users")
+            runs.append({"workers": workers, "saturation_users": saturation, "steps": steps})
+
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": socket.gethostname(),
+            "base_url": args.base_url,
+            "stub_office": args.stub_office,
+            "settings": {k: v for k, v in vars(args).items() if k not in ("password",)},
+            "runs": runs,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+On-demand profiling of a single call, for diagnosing slow conversions.
+
+Two modes:
+
+* "sampling": a background thread snapshots the calling thread's stack every
+  few milliseconds. Low overhead; the result is in the "folded stacks" format
+  (one `frame;frame;frame count` line per stack) that flamegraph.pl,
+  speedscope and inferno read directly.
+* "deterministic": cProfile for the calling thread. Exact call counts, higher
+  overhead; the result is a pstats dump (open with snakeviz or flameprof).
+
+Nothing here runs unless a Profile is entered.
+"""
+import cProfile
+import io
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+MODES = ("sampling", "deterministic")
+
+FILE_EXTENSIONS = {"sampling": "folded.txt", "deterministic": "prof"}
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> bytes:
+        lines = [f"{stack} {count}" for stack, count in self.samples.most_common()]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _pstats_bytes(profiler: cProfile.Profile) -> bytes:
+    # Same layout as Profile.dump_stats(), without a temp file
+    profiler.create_stats()
+    buf = io.BytesIO()
+    marshal.dump(profiler.stats, buf)
+    return buf.getvalue()
+
+
+class Profile:
+    """
+    Context manager profiling the current thread:
+
+        with Profile("sampling") as prof:
+            do_work()
+        prof.data  # bytes, also set when do_work() raised
+    """
+
+    def __init__(self, mode: str):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.mode = mode
+        self.data = b""
+        self.elapsed = 0.0
+        self._profiler = None
+
+    @property
+    def extension(self):
+        return FILE_EXTENSIONS[self.mode]
+
+    def __enter__(self):
+        if self.mode == "deterministic":
+            self._profiler = cProfile.Profile()
+        else:
+            self._profiler = SamplingProfiler(threading.get_ident())
+        self._start = time.perf_counter()
+        if self.mode == "deterministic":
+            self._profiler.enable()
+        else:
+            self._profiler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.mode == "deterministic":
+            self._profiler.disable()
+            self.data = _pstats_bytes(self._profiler)
+        else:
+            self._profiler.stop()
+            self.data = self._profiler.folded()
+        self.elapsed = time.perf_counter() - self._start
+        return False
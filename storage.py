@@ -0,0 +1,233 @@
+"""
+Blob storage for uploaded documents, conversion outputs and payment receipts.
+
+Objects are addressed by keys that look like relative paths
+("uploads/<job_id>.docx", "outputs/<job_id>.txt"). Two backends:
+
+* LocalStorage keeps each key as a file under a root directory. With the
+  default root (the app directory) keys map onto the existing uploads/ and
+  outputs/ folders, so nothing has to be moved. Several workers on one box,
+  or several boxes sharing an NFS mount, can use it.
+* S3Storage keeps objects in a bucket on any S3-compatible store (AWS S3,
+  MinIO, ...). boto3 is imported on first use and only needed here.
+
+Pick one with STORAGE_BACKEND=local|s3 (see from_env).
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+class StorageError(Exception):
+    pass
+
+
+class NotFound(StorageError):
+    pass
+
+
+class LocalStorage:
+    backend = "local"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Key escapes storage root: {key}")
+        return path
+
+    def _target(self, key: str) -> str:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def put_file(self, key: str, src_path: str, move: bool = False):
+        target = self._target(key)
+        if os.path.abspath(src_path) == target:
+            return
+        if move:
+            shutil.move(src_path, target)
+        else:
+            shutil.copyfile(src_path, target)
+
+    def put_fileobj(self, key: str, fileobj):
+        with open(self._target(key), "wb") as out:
+            shutil.copyfileobj(fileobj, out)
+
+    def put_bytes(self, key: str, data: bytes):
+        with open(self._target(key), "wb") as out:
+            out.write(data)
+
+    def get_bytes(self, key: str) -> bytes:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise NotFound(key)
+
+    @contextmanager
+    def local_file(self, key: str):
+        """Yields a local path with the object's content (here: the file itself)."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise NotFound(key)
+        yield path
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def size(self, key: str) -> int:
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            raise NotFound(key)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def iter_chunks(self, key: str, chunk_size: int = 64 * 1024):
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            raise NotFound(key)
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class S3Storage:
+    backend = "s3"
+
+    def __init__(self, bucket: str, endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 prefix: str = "", presign_ttl: int = 300):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.presign_ttl = presign_ttl
+        self._client_args = {
+            "endpoint_url": endpoint_url or None,
+            "region_name": region or None,
+            "aws_access_key_id": access_key or None,
+            "aws_secret_access_key": secret_key or None,
+        }
+        self._client = None
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe; one per process is enough
+        if self._client is None:
+            import boto3
+            self._client = boto3.client("s3", **self._client_args)
+        return self._client
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _missing(self, error) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def put_file(self, key: str, src_path: str, move: bool = False):
+        self.client.upload_file(src_path, self.bucket, self._key(key))
+        if move:
+            os.remove(src_path)
+
+    def put_fileobj(self, key: str, fileobj):
+        self.client.upload_fileobj(fileobj, self.bucket, self._key(key))
+
+    def put_bytes(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def get_bytes(self, key: str) -> bytes:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+        except Exception as e:
+            if self._missing(e):
+                raise NotFound(key)
+            raise
+
+    @contextmanager
+    def local_file(self, key: str):
+        """Downloads the object to a temporary file, removed on exit."""
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        try:
+            try:
+                self.client.download_file(self.bucket, self._key(key), path)
+            except Exception as e:
+                if self._missing(e):
+                    raise NotFound(key)
+                raise
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except Exception as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def size(self, key: str) -> int:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except Exception as e:
+            if self._missing(e):
+                raise NotFound(key)
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def presigned_url(self, key: str, filename=None, media_type=None) -> str:
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        if media_type:
+            params["ResponseContentType"] = media_type
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.presign_ttl)
+
+    def iter_chunks(self, key: str, chunk_size: int = 64 * 1024):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+        except Exception as e:
+            if self._missing(e):
+                raise NotFound(key)
+            raise
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+
+def from_env(default_root: str):
+    backend = os.getenv("STORAGE_BACKEND", "local").lower()
+    if backend == "local":
+        return LocalStorage(os.getenv("STORAGE_ROOT", default_root))
+    if backend == "s3":
+        bucket = os.getenv("S3_BUCKET")
+        if not bucket:
+            raise StorageError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        return S3Storage(
+            bucket,
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            region=os.getenv("S3_REGION"),
+            access_key=os.getenv("S3_ACCESS_KEY"),
+            secret_key=os.getenv("S3_SECRET_KEY"),
+            prefix=os.getenv("S3_PREFIX", ""),
+            presign_ttl=int(os.getenv("S3_PRESIGN_TTL", 300)),
+        )
+    raise StorageError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,199 @@
+"""
+Synthetic question-table documents for benchmarks and load tests.
+
+Builds .docx files (and the equivalent filtered HTML an office export would
+produce) with the table layout convert_to_gift expects:
+
+    No | Savol | To'g'ri javob | Muqobil javob 1 | ... | Muqobil javob N
+
+Only the standard library is used, so documents can be generated on any box.
+"""
+import os
+import random
+import struct
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+
+PLAIN_WORDS = [
+    "matematika", "fizika", "tarix", "javob", "hisoblang", "toping", "qiymat",
+    "funksiya", "tenglama", "burchak", "uchburchak", "kvadrat", "son", "natija",
+]
+UNICODE_WORDS = [
+    "oʻzbekcha", "gʻalaba", "Қорақалпоғистон", "ўқувчи", "π≈3,14", "√x²", "∑aᵢ",
+    "α+β=γ", "日本語", "Ελληνικά", "déjà-vu", "naïve", "🚀", "ℝ→ℝ",
+]
+ESCAPING_WORDS = [
+    "{a}", "x=1", "~y", "#5", "a:b", "<tag>", "x>y", "a&b", "\\n", "{=~}",
+    "f(x)={x}", "100%", "a==b", "::title::",
+]
+CONTENT_KINDS = {"plain": PLAIN_WORDS, "unicode": UNICODE_WORDS, "escaping": ESCAPING_WORDS}
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Default Extension="png" ContentType="image/png"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+_DOC_NS = (
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+    'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"'
+)
+
+EMU_PER_PIXEL = 9525
+
+
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """A noisy RGB gradient, so the file size behaves like a real screenshot."""
+    rnd = random.Random(seed)
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0)  # filter: none
+        for x in range(width):
+            raw += bytes((
+                (x * 255 // max(width - 1, 1)) ^ rnd.randrange(32),
+                (y * 255 // max(height - 1, 1)) ^ rnd.randrange(32),
+                (seed * 37) & 0xFF,
+            ))
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(bytes(raw), 6)) + chunk(b"IEND", b"")
+
+
+def make_questions(rows: int, distractors: int = 3, content: str = "plain",
+                   image_every: int = 0, seed: int = 42):
+    """
+    Returns a list of row dicts: {"question", "correct", "distractors", "image"}.
+    Every `image_every`-th question carries an image (0 disables images).
+    """
+    words = CONTENT_KINDS[content]
+    rnd = random.Random(seed)
+
+    def phrase(n):
+        return " ".join(rnd.choice(words) for _ in range(n))
+
+    questions = []
+    for i in range(rows):
+        questions.append({
+            "question": f"{i + 1}. {phrase(rnd.randint(6, 14))}?",
+            "correct": phrase(rnd.randint(1, 4)),
+            "distractors": [phrase(rnd.randint(1, 4)) for _ in range(distractors)],
+            "image": bool(image_every) and i % image_every == 0,
+        })
+    return questions
+
+
+def _run(text: str) -> str:
+    return f'<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r>'
+
+
+def _image_run(rel_id: str, index: int, width: int, height: int) -> str:
+    cx, cy = width * EMU_PER_PIXEL, height * EMU_PER_PIXEL
+    return (
+        f'<w:r><w:drawing><wp:inline><wp:extent cx="{cx}" cy="{cy}"/>'
+        f'<wp:docPr id="{index}" name="Picture {index}"/>'
+        '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+        f'<pic:pic><pic:nvPicPr><pic:cNvPr id="{index}" name="image{index}.png"/><pic:cNvPicPr/></pic:nvPicPr>'
+        f'<pic:blipFill><a:blip r:embed="{rel_id}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+        f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+        '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr></pic:pic>'
+        '</a:graphicData></a:graphic></wp:inline></w:drawing></w:r>'
+    )
+
+
+def _cell(runs: str) -> str:
+    return f"<w:tc><w:p>{runs}</w:p></w:tc>"
+
+
+def _header(distractors: int):
+    return ["No", "Savol", "To'g'ri javob"] + [f"Muqobil javob {i + 1}" for i in range(distractors)]
+
+
+def write_docx(path: str, questions: list, image_size=(200, 150)):
+    """Writes `questions` (see make_questions) as a one-table .docx file."""
+    distractors = max((len(q["distractors"]) for q in questions), default=0)
+    rels = []
+    media = {}
+    rows_xml = ["<w:tr>" + "".join(_cell(_run(h)) for h in _header(distractors)) + "</w:tr>"]
+
+    for i, q in enumerate(questions):
+        question_runs = _run(q["question"])
+        if q["image"]:
+            n = len(media) + 1
+            rel_id = f"rIdImg{n}"
+            media[f"word/media/image{n}.png"] = make_png(*image_size, seed=n)
+            rels.append(f'<Relationship Id="{rel_id}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/image{n}.png"/>')
+            question_runs += _image_run(rel_id, n, *image_size)
+        cells = [_run(str(i + 1)), question_runs, _run(q["correct"])]
+        cells += [_run(d) for d in q["distractors"]]
+        rows_xml.append("<w:tr>" + "".join(_cell(c) for c in cells) + "</w:tr>")
+
+    document = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document {_DOC_NS}><w:body>'
+        '<w:tbl><w:tblPr><w:tblW w:w="0" w:type="auto"/></w:tblPr>'
+        + "".join(rows_xml) +
+        '</w:tbl><w:p/></w:body></w:document>'
+    )
+    doc_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + "".join(rels) + "</Relationships>"
+    )
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        z.writestr("_rels/.rels", _ROOT_RELS)
+        z.writestr("word/document.xml", document)
+        z.writestr("word/_rels/document.xml.rels", doc_rels)
+        for name, data in media.items():
+            z.writestr(name, data)
+    return path
+
+
+def write_html(directory: str, name: str, questions: list, image_size=(200, 150)):
+    """
+    Writes the filtered HTML an office export of the same document would give
+    (`<name>.html` plus `<name>_files/`), for benchmarking without LibreOffice.
+    Returns (html_path, files_dir).
+    """
+    files_dir = os.path.join(directory, f"{name}_files")
+    os.makedirs(files_dir, exist_ok=True)
+    distractors = max((len(q["distractors"]) for q in questions), default=0)
+
+    rows = ["<tr>" + "".join(f"<td><p>{escape(h)}</p></td>" for h in _header(distractors)) + "</tr>"]
+    image_no = 0
+    for i, q in enumerate(questions):
+        question_html = f"<p>{escape(q['question'])}</p>"
+        if q["image"]:
+            image_no += 1
+            image_name = f"image{image_no:03d}.png"
+            with open(os.path.join(files_dir, image_name), "wb") as f:
+                f.write(make_png(*image_size, seed=image_no))
+            question_html += f'<p><img width="{image_size[0]}" height="{image_size[1]}" src="{name}_files/{image_name}"></p>'
+        cells = [f"<p>{i + 1}</p>", question_html, f"<p>{escape(q['correct'])}</p>"]
+        cells += [f"<p>{escape(d)}</p>" for d in q["distractors"]]
+        rows.append("<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>")
+
+    html = (
+        '<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"><title></title>'
+        '<style>p { margin-bottom: 0.1in }</style></head><body>'
+        '<table cellpadding="7" cellspacing="0">' + "".join(rows) + "</table></body></html>"
+    )
+    html_path = os.path.join(directory, f"{name}.html")
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(html)
+    return html_path, files_dir